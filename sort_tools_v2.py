@@ -1,27 +1,60 @@
 #sort_tools module
 #version 2
 #now organized with a class structure
-#file contains Four classes: Sort_tools, Db_tools, and Data_construct and Archive
+#file contains Nine classes: Sort_tools, Db_tools, Column_profiler, Key_registry, Key_translator, Folder_manifest, Lazy_frames, and Data_construct and Archive
 #Sort_tools contains functions for munging and manipulating data - these are the best versions and most useful functions I've developed
 #Db_tools contains functions for interacting with database and solving db related problems
+#Column_profiler computes and caches value counts, distinct and null counts for the unique value functions in Sort_tools
+#Key_translator is a reusable translator table for swapping keys with switcheroo_v3
+#Key_registry keeps surrogate keys from unique_val_table stable across batches by storing them on disk
+#Folder_manifest is a saved recursive listing of a folder tree that only rescans folders that have changed
+#Lazy_frames is the load on first use, memory capped dictionary Data_construct uses for dfs when lazy=True
 #Data_construct is for analyses requiring multiple data files it scans a folder, loads csv and parquet files into dataframes, and organizes them in a dictionary structure
 #Archive is for older functions and versions - I keep them around for reference, but don't want to import them routinely, as most have been supersceded by better ways of doing things.
 
 import pandas as pd
 import numpy as np
-import xlwings as xw
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import pyarrow.dataset
+try:
+    import xlwings as xw
+except ImportError:
+    xw = None
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
 import os
+import sys
+import time
 import datetime as dt
+import functools
+import logging
+import json
+import re
+import hashlib
+import weakref
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+logger=logging.getLogger(__name__)
 
 class Sort_tools:
 
     @staticmethod
-    def pt_date_interval_v4(df:object, id_str:str, date_str:str)->object:
+    def pt_date_interval_v4(df:object, id_str:str, date_str:str, list_mode:str='string')->object:
         '''
         This is essentially an improved, more pythonic rewrite of the first version of this function.
         v4 takes one less parameter, returns a df, and uses pandas groupby and vector operations instead of iteration. 
         The df required should contain a list of patient ids and scan dates, such that there is one line per scan date 
         (duplicates will be dropped). Dates should be typed as datetime.
+        list_mode: 'string' (default) gives unique_date_list as a python list of YYYYMMDD strings per patient, same as always.
+        'arrow' keeps the dates typed the whole way through and builds unique_date_list as an arrow list<date32> column 
+        straight from offsets and values, so no python objects are made per patient. Use this on big scan tables. 
+        Rows with a null id or date are dropped in arrow mode.
         Return fields:
         unique_date_list - all the scan dates per patient (list)
         first_date - earliest scan date per patient
@@ -29,12 +62,17 @@ class Sort_tools:
         date_count - count of scan dates
         LongestIntDays - days between first and last scans
         '''
+        if list_mode=='arrow':
+            return Sort_tools._pt_date_interval_arrow(df, id_str, date_str)
+        elif list_mode!='string':
+            raise ValueError(f"list_mode must be 'string' or 'arrow', got {list_mode}")
+
         groups=df[[id_str, date_str]].copy()
 
         groups=groups.drop_duplicates()
         groups=groups.sort_values(by=[id_str, date_str])
-        groups['converted_dates']=pd.to_datetime(groups[date_str].astype(str), format='%Y-%m-%d')
-        groups['converted_dates']=groups['converted_dates'].dt.strftime('%Y%m%d')
+        #dates are already datetime, so format them directly instead of going through str and back
+        groups['converted_dates']=pd.to_datetime(groups[date_str]).dt.strftime('%Y%m%d')
 
         groups=groups.groupby(id_str).agg(
             unique_date_list=pd.NamedAgg(column='converted_dates', aggfunc=list),
@@ -48,40 +86,99 @@ class Sort_tools:
     
         groups=groups[[id_str, 'first_date', 'last_date', 'date_count', 'LongestIntDays', 'unique_date_list']].copy()    
         return groups
+
+    @staticmethod
+    def _group_starts(ids:object)->object:
+        '''
+        Takes an array of ids that is already sorted and returns the position where each id's block starts
+        '''
+        if len(ids)==0:
+            return np.zeros(0, dtype=np.int64)
+        new_group=np.empty(len(ids), dtype=bool)
+        new_group[0]=True
+        new_group[1:]=ids[1:]!=ids[:-1]
+        return np.flatnonzero(new_group)
+
+    @staticmethod
+    def _pt_date_interval_arrow(df:object, id_str:str, date_str:str)->object:
+        '''
+        Array version of pt_date_interval_v4 used for list_mode='arrow'. One sort, then everything comes from the group offsets.
+        '''
+        groups=df[[id_str, date_str]].dropna()
+        groups=groups.sort_values(by=[id_str, date_str])
+        ids=groups[id_str].to_numpy()
+        dates=groups[date_str].to_numpy().astype('datetime64[ns]')
+
+        #drop duplicates on adjacent rows, which is all of them after the sort
+        if len(ids)>0:
+            keep=np.empty(len(ids), dtype=bool)
+            keep[0]=True
+            keep[1:]=(ids[1:]!=ids[:-1])|(dates[1:]!=dates[:-1])
+            ids=ids[keep]
+            dates=dates[keep]
+
+        starts=Sort_tools._group_starts(ids)
+        offsets=np.append(starts, len(ids))
+        first_date=dates[starts]
+        last_date=dates[offsets[1:]-1]
+
+        values=pa.array(dates.astype('datetime64[D]'), type=pa.date32())
+        date_lists=pa.ListArray.from_arrays(pa.array(offsets, type=pa.int32()), values)
+
+        groups=pd.DataFrame({
+            id_str:ids[starts],
+            'first_date':first_date,
+            'last_date':last_date,
+            'date_count':np.diff(offsets),
+            'LongestIntDays':((last_date-first_date)//np.timedelta64(1, 'D')).astype(int),
+            'unique_date_list':pd.Series(pd.arrays.ArrowExtensionArray(date_lists))
+        })
+        return groups
     
 
     @staticmethod
-    def print_unique(df:object, key_list:list) -> None:
+    def print_unique(df:object, key_list:list, cached:bool=False) -> None:
         
-        '''Takes a list of keys from a df, iterates through and prints unique values for each'''
+        '''Takes a list of keys from a df, iterates through and prints unique values for each
+        cached: if True values come from the Column_profiler cache, so repeat calls on the same df are instant. 
+        The cache does not see cells edited in place, call Column_profiler.clear() after editing'''
+        
+        profiles = Column_profiler.profile(df, key_list, cached=cached)
         
         for key in key_list:
         
-            u_vals = set(df[key].to_list())
+            u_vals = set(profiles[key]['value_counts'].index)
         
             print(f'unique values in column {key} are: {u_vals}')
 
         return
 
     @staticmethod        
-    def find_unique(dataframe:object, key:str) -> set:
+    def find_unique(dataframe:object, key:str, cached:bool=False) -> set:
 
         '''This function takes a dataframe and key, 
-        and returns a set of unique values from that column of the df'''
+        and returns a set of unique values from that column of the df
+        cached: if True values come from the Column_profiler cache, so repeat calls on the same df are instant. 
+        The cache does not see cells edited in place, call Column_profiler.clear() after editing'''
         
-        #send the dataframe[key] column to a list
-        fun_list = dataframe[key]
+        #value counts from the profiler, keyed by the unique values
+        fun_counts = Column_profiler.profile(dataframe, [key], cached=cached)[key]['value_counts']
         
         #use set() to find unique values in the list
-        fun_set = set(fun_list)
+        fun_set = set(fun_counts.index)
         
         return fun_set
 
     @staticmethod
-    def unique_val_table(df:object, id_string:str) -> object:
+    def unique_val_table(df:object, id_string:str, registry:object=None) -> object:
         
         '''Takes a table with repeating values, drops dupes, resets index and sets up an integer key with 
-        the column title given by the id_string. df should be a dataframe, and id_string should be a string '''
+        the column title given by the id_string. df should be a dataframe, and id_string should be a string 
+        registry: optional Key_registry. If passed, keys come from the registry instead of being numbered from scratch, 
+        so rows that have been seen before keep their key and only new rows get new ones'''
+        
+        if registry is not None:
+            return registry.assign(df, id_string)
         
         #find unique values and scrub initial index values
 
@@ -105,11 +202,15 @@ class Sort_tools:
         
         '''Use a traslator table between two keys to swap keys
 
-        Translate_df: df with one column for the desired key, and one for the old key.
+        Translate_df: df with one column for the desired key, and one for the old key. A Key_translator built from 
+        the df can be passed instead, which is much faster when the same translator is used over and over
         
         This function is way better for long columns than v2
         '''
         
+        if isinstance(translate_df, Key_translator):
+            return translate_df.translate(target_df)
+        
         target_df = pd.merge(translate_df, target_df, on = target_key, how = 'right')
         
         target_df = target_df.drop(columns = [target_key])
@@ -117,20 +218,73 @@ class Sort_tools:
         return target_df 
 
     @staticmethod
-    #use merges to count matching values
-    def count_matching(df1:object, df2:object, match_key:str) -> int:
+    #count matching values from key counts, without doing the merge
+    def count_matching(df1:object, df2:object, match_key:str, approximate:bool=False, sketch_width:int=2**16, sketch_depth:int=5) -> int:
+        
+        '''Returns a count based on the records that match in two different dataframes 
         
-        '''Returns a count based on the records that match in two different dataframes '''
+        The count is the same as len() of the inner merge, but is worked out as the sum over keys of (count in df1 * count in df2),
+        so the merge is never built. match_key can be a column name or a list of them.
+        approximate: if True estimate the count from small AGMS style sketches (sketch_width x sketch_depth counters per frame)
+        instead of exact key counts, for very big inputs with a lot of distinct keys
+        '''
         
-        match = pd.merge(df1, df2, how = 'inner', on = match_key)
+        if approximate==True:
+            sketch1=Sort_tools.join_sketch(df1, match_key, sketch_width, sketch_depth)
+            sketch2=Sort_tools.join_sketch(df2, match_key, sketch_width, sketch_depth)
+            return Sort_tools.sketch_join_size(sketch1, sketch2)
         
-        match_count = len(match)
+        match_count = Sort_tools.key_count_join_size(Sort_tools.key_counts(df1, match_key), Sort_tools.key_counts(df2, match_key))
         
         return match_count
 
+    @staticmethod
+    def count_matching_batch(ref_df:object, df_list:list, match_key:str) -> list:
+        
+        '''Same as count_matching for one reference df against a list of dfs. The reference key counts are only worked out once'''
+        
+        ref_counts=Sort_tools.key_counts(ref_df, match_key)
+        
+        return [Sort_tools.key_count_join_size(ref_counts, Sort_tools.key_counts(df, match_key)) for df in df_list]
+
+    @staticmethod
+    def key_counts(df:object, match_key) -> object:
+        '''Rows per key value (or key combination). Nulls are counted too, since merge matches null to null'''
+        if isinstance(match_key, str):
+            return df[match_key].value_counts(dropna=False)
+        return df[list(match_key)].value_counts(dropna=False)
+
+    @staticmethod
+    def key_count_join_size(counts1:object, counts2:object) -> int:
+        '''Inner join size from two sets of key counts'''
+        shared=counts2.reindex(counts1.index, fill_value=0)
+        return int((counts1.to_numpy(dtype=np.int64)*shared.to_numpy(dtype=np.int64)).sum())
 
     @staticmethod
-    #use this function to iteratively filter dfs
+    def join_sketch(df:object, match_key, sketch_width:int, sketch_depth:int) -> object:
+        '''
+        Builds a sketch_depth x sketch_width array of signed counters from the hashed keys of df. Two sketches built with the
+        same width and depth can be combined by sketch_join_size to estimate the join size.
+        '''
+        keys=match_key if isinstance(match_key, str) else list(match_key)
+        hashes=pd.util.hash_pandas_object(df[keys], index=False).to_numpy()
+        sketch=np.zeros((sketch_depth, sketch_width), dtype=np.float64)
+        for row in range(sketch_depth):
+            #remix the hash for each row so the rows are independent
+            mixed=(hashes^np.uint64(0x9E3779B97F4A7C15*(row+1) % 2**64))*np.uint64(0xBF58476D1CE4E5B9)
+            mixed^=mixed>>np.uint64(31)
+            buckets=(mixed % np.uint64(sketch_width)).astype(np.int64)
+            signs=np.where((mixed>>np.uint64(63))==1, 1.0, -1.0)
+            sketch[row]=np.bincount(buckets, weights=signs, minlength=sketch_width)
+        return sketch
+
+    @staticmethod
+    def sketch_join_size(sketch1:object, sketch2:object) -> int:
+        '''Join size estimate from two join_sketch arrays, the median over rows of the counter dot products'''
+        return int(round(float(np.median((sketch1*sketch2).sum(axis=1)))))
+
+    @staticmethod
+    #use this function to iteratively filter dfs - filter_bands does several bands in one go
     def filter_base(df:object, lower_bound:int, upper_bound:int, key_string:str) -> object:
         
         '''filters a dataframe based on a key string and interger lower and upper bounds'''
@@ -140,15 +294,52 @@ class Sort_tools:
         return age_bound
 
     @staticmethod
-    def count_groups(df:object, group_key:str, count_key:str) -> object:
+    def filter_bands(df:object, bands:list, key_string:str, return_positions:bool=False) -> dict:
+        
+        '''
+        Splits a dataframe into several [lower, upper) bands of one column in a single call, instead of calling filter_base
+        once per band. The column is argsorted once and each band is found with two binary searches.
+        bands: list of (lower_bound, upper_bound) pairs, eg [(0, 18), (18, 40), (40, 65)]
+        return_positions: if True return the row positions of each band (numpy arrays, in row order) instead of dataframes
+        Returns a dict keyed by the (lower_bound, upper_bound) pairs. Each band dataframe is the same as filter_base would give.
+        '''
+        
+        values = df[key_string].to_numpy()
+        order = np.argsort(values, kind='stable')
+        sorted_vals = values[order]
+        
+        band_dict = {}
+        for lower_bound, upper_bound in bands:
+            start = np.searchsorted(sorted_vals, lower_bound, side='left')
+            stop = max(np.searchsorted(sorted_vals, upper_bound, side='left'), start)
+            #back into row order so the band matches a boolean filter
+            positions = np.sort(order[start:stop])
+            if return_positions:
+                band_dict[(lower_bound, upper_bound)] = positions
+            else:
+                band_dict[(lower_bound, upper_bound)] = df.iloc[positions]
+        
+        return band_dict
+
+    @staticmethod
+    def count_groups(df:object, group_key:str, count_key:str, cached:bool=False) -> object:
         
         '''
         Does a groupby calculation to enumerate the members of a group in a particular dataframe
         
         Returns a dataframe in the format I generally find desirable for this kind of analysis
+        If count_key has no nulls the counts come straight from the Column_profiler value counts of group_key
+        cached: if True the value counts are kept in the Column_profiler cache (see find_unique)
         
         '''
         
+        if not df[count_key].isna().any():
+            counts = Column_profiler.profile(df, [group_key], cached=cached)[group_key]['value_counts']
+            #unobserved categories come back with 0, the groupby leaves them out
+            counts = counts[counts.index.notna() & (counts.to_numpy() > 0)].sort_index()
+            prune_df = pd.DataFrame({group_key: counts.index, 'count': counts.to_numpy()})
+            return prune_df
+        
         prune_df = df[[group_key, count_key]].copy()        
         prune_df = prune_df.groupby(group_key).count()        
         prune_df = prune_df.reset_index()        
@@ -157,7 +348,7 @@ class Sort_tools:
         return prune_df
    
     @staticmethod
-    def substring_filter_v3(df:object, ta_key:str, keywords:list, delimiter:str, exclude:bool) -> object:
+    def substring_filter_v3(df:object, ta_key:str, keywords:list, delimiter:str, exclude:bool, engine:str='automaton') -> object:
             
         '''
         Filter a dataframe using substrings in a string column.
@@ -173,10 +364,24 @@ class Sort_tools:
 
         exclude: If True, the filtration will remove rows lacking the keywords
 
+        engine: 'automaton' (default) builds one matcher for the whole keyword list (cached, see keyword_pattern) and 
+        scans the column in a single vectorized pass. 'loop' is the original row by row version. Both give the same rows. 
+        Null strings never match in automaton mode.
+
         better version of substring_filter - this one uses the 'in' keyword instead of matching words in a list 
         split by the delimiter, so word combinations containing the delimiter can be passed in the keywords list
             
         '''
+        #the automaton lowers whole strings, which is only the same as lowering the pieces if the delimiter has no case
+        if engine=='automaton' and delimiter.lower()==delimiter:
+            key_mask=Sort_tools.keyword_mask(df[ta_key], keywords)
+            if exclude == True:
+                return df[~key_mask]
+            else:
+                return df[key_mask]
+        elif engine not in ('automaton', 'loop'):
+            raise ValueError(f"engine must be 'automaton' or 'loop', got {engine}")
+
         #add the array to a list
         df_list = df[ta_key].to_list()        
         #lower the case of the keyword
@@ -208,6 +413,34 @@ class Sort_tools:
         df = df.drop(columns = ['key_binary'])        
         return df
 
+    @staticmethod
+    @functools.lru_cache(maxsize=64)
+    def keyword_pattern(keywords:tuple) -> str:
+        '''
+        Compiles a tuple of keywords into a single lowered, escaped alternation. This runs once per keyword list and is cached,
+        so repeat filters with the same list skip it. The pattern is run by pyarrow's RE2 engine, which turns the whole 
+        alternation into one automaton, so each string is scanned once no matter how many keywords there are.
+        '''
+        special=set('\\.^$|?*+()[]{}')
+        escaped=[]
+        for key in keywords:
+            escaped.append(''.join(f'\\{c}' if c in special else c for c in key.lower()))
+        return '|'.join(escaped)
+
+    @staticmethod
+    def keyword_mask(column:object, keywords:list) -> object:
+        '''
+        Returns a boolean numpy array that is True where a string column contains any of the keywords (case insensitive)
+        column: a pandas series of strings
+        keywords: a list of strings
+        '''
+        if len(keywords)==0:
+            return np.zeros(len(column), dtype=bool)
+        pattern=Sort_tools.keyword_pattern(tuple(keywords))
+        lowered=pa.array(column.astype(object).str.lower(), type=pa.large_string(), from_pandas=True)
+        hits=pc.match_substring_regex(lowered, pattern)
+        return pc.fill_null(hits, False).to_numpy(zero_copy_only=False)
+
     @staticmethod
     def string_appender(column:list, subst:str) -> list:
     
@@ -216,24 +449,12 @@ class Sort_tools:
         numeric values in the input list ('column') will have the substring value ('subst') appended. 
         The function will transfer null values, without modifying them.
         The column has to be set as dtype = str before this function will work. 
+        Runs on normalize_ids, use that directly on big columns to skip the list round trip.
         '''
         
-        out_list = []
+        out_col=Sort_tools.normalize_ids(pd.Series(column, dtype=object), prefix=subst)
         
-        for name in column:
-
-            
-            if name is None:
-                out_list.append(None)
-            
-            elif name.isnumeric():            
-                nname = f'{subst}{name}'            
-                out_list.append(nname)
-                
-            else:
-                out_list.append(name)
-            
-        return out_list
+        return out_col.to_numpy(dtype=object, na_value=None).tolist()
 
     @staticmethod
     def fix_mrn(mrn_list:list) -> list:
@@ -242,33 +463,74 @@ class Sort_tools:
         Takes MRN list in and fixes the format so that there are a correct number of leading zeros
 
         The MRN list needs to be typed as int beforehand, or string, without a decimal        
+        Runs on normalize_ids, use that directly on big columns to skip the list round trip. Nulls are passed through.
         '''
         
-        fixed_mrn = []
-        
-        #iterate through the mrn list
-        for mrn in mrn_list:
+        fixed_mrn=Sort_tools.normalize_ids(pd.Series(mrn_list), width=9)
             
-            #calculate zeroes needed
-            mrn_string = str(mrn)
-            
-            zeros_needed = 9 - len(mrn_string)
-            
-            #add zeros to the front of the mrn until there are 9 digits
-            for n in range(zeros_needed):            
-                mrn_string = str(0) + mrn_string
-                
-            #add fixed mrn to the list            
-            fixed_mrn.append(mrn_string)
-            
-        return fixed_mrn
+        return fixed_mrn.to_numpy(dtype=object, na_value=None).tolist()
 
     @staticmethod
-    def dframe_a_sheet(sheet_name:str, cell_range:str, file_path:str) -> object:
+    def normalize_ids(column:object, width:int=None, prefix:str=None, output:str='string') -> object:
+    
+        '''
+        Columnar identifier clean up. Works on a whole pandas series or arrow array at once with arrow string kernels, nulls stay null.
+        
+        column: pandas series, or pyarrow array / chunked array, of ids. Numbers are converted to strings first
+        width: if given, ids shorter than this are left padded with zeros (fix_mrn uses 9)
+        prefix: if given, ids made only of numeric characters get this put on the front (what string_appender does)
+        output: 'string' returns an arrow backed string series, 'category' returns a categorical series, 
+        'bytes' returns a numpy fixed width bytes array masked where the ids are null. The last two save a lot of memory.
+        '''
+        
+        index=column.index if isinstance(column, pd.Series) else None
+        if isinstance(column, pd.Series):
+            try:
+                arr=pa.array(column, from_pandas=True)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                #mixed numbers and strings in an object column
+                arr=pa.array(column.map(str, na_action='ignore'), from_pandas=True)
+        else:
+            arr=column
+        if not (pa.types.is_string(arr.type) or pa.types.is_large_string(arr.type)):
+            arr=pc.cast(arr, pa.string())
+        
+        if width is not None:
+            arr=pc.utf8_lpad(arr, width=width, padding='0')
+        if prefix is not None:
+            prefixed=pc.binary_join_element_wise(pa.scalar(prefix, type=arr.type), arr, pa.scalar('', type=arr.type))
+            arr=pc.if_else(pc.utf8_is_numeric(arr), prefixed, arr)
+        
+        if output=='string':
+            out_col=pd.Series(pd.arrays.ArrowExtensionArray(arr))
+        elif output=='category':
+            if isinstance(arr, pa.ChunkedArray):
+                arr=arr.combine_chunks()
+            encoded=pc.dictionary_encode(arr)
+            codes=pc.fill_null(encoded.indices, -1).to_numpy(zero_copy_only=False)
+            out_col=pd.Series(pd.Categorical.from_codes(codes, categories=pd.Index(encoded.dictionary.to_pylist())))
+        elif output=='bytes':
+            nulls=pc.is_null(arr).to_numpy(zero_copy_only=False)
+            filled=pc.cast(pc.fill_null(arr, ''), pa.binary()).to_numpy(zero_copy_only=False)
+            return np.ma.masked_array(np.array(filled, dtype='S'), mask=nulls)
+        else:
+            raise ValueError(f"output must be 'string', 'category' or 'bytes', got {output}")
+        
+        if index is not None:
+            out_col.index=index
+        return out_col
+
+    @staticmethod
+    def dframe_a_sheet(sheet_name:str, cell_range:str, file_path:str, engine:str='auto') -> object:
 
         '''
         Creates a pandas dataframe from an excel sheet
+        engine: 'xlwings' drives a live copy of Excel, 'openpyxl' reads the .xlsx file directly in read only mode with no Excel 
+        needed (works on linux). 'auto' uses xlwings when it's installed on windows or mac, otherwise openpyxl
         '''
+        
+        if Sort_tools.excel_engine(engine)=='openpyxl':
+            return pd.concat(Sort_tools.iter_sheet_chunks(sheet_name, file_path, cell_range=cell_range), ignore_index=True)
     
         #create an xw Book object from the file path
         db_book = xw.Book(file_path)
@@ -283,11 +545,15 @@ class Sort_tools:
         return dummy_df
     
     @staticmethod
-    def dframe_a_sheet_v2(sheet_name:str, file_path:str) -> object:
+    def dframe_a_sheet_v2(sheet_name:str, file_path:str, engine:str='auto') -> object:
         '''
         This better version of dframe_a_sheet doesn't need the shape of the data in your sheet
         It assumes your data starts on A1
+        engine: same as dframe_a_sheet
         '''    
+        if Sort_tools.excel_engine(engine)=='openpyxl':
+            return pd.concat(Sort_tools.iter_sheet_chunks(sheet_name, file_path), ignore_index=True)
+        
         #create an xw Book object from the file path
         db_book = xw.Book(file_path)
 
@@ -301,9 +567,71 @@ class Sort_tools:
         return dummy_df
 
     @staticmethod
-    def folder_list(f_path:str) -> list:
+    def excel_engine(engine:str) -> str:
+        '''Picks the excel reader for the dframe_a_sheet functions'''
+        if engine=='auto':
+            if xw is not None and sys.platform in ('win32', 'darwin'):
+                return 'xlwings'
+            engine='openpyxl'
+        if engine=='openpyxl' and openpyxl is None:
+            raise ImportError('openpyxl is needed to read excel files without Excel, pip install openpyxl')
+        if engine=='xlwings' and xw is None:
+            raise ImportError('xlwings is not installed')
+        if engine not in ('openpyxl', 'xlwings'):
+            raise ValueError(f"engine must be 'auto', 'openpyxl' or 'xlwings', got {engine}")
+        return engine
+
+    @staticmethod
+    def iter_sheet_chunks(sheet_name:str, file_path:str, chunk_size:int=100000, cell_range:str=None):
+        '''
+        Streams an excel sheet with openpyxl in read only mode and yields dataframes of up to chunk_size rows, so very big
+        sheets never have to be in memory at once. The first row of the range is the header.
+        cell_range: an A1 style range like 'A1:F500'. If None, the table is expanded from A1 the way xlwings expand() does, 
+        right until the first empty header cell and down until the first empty cell in the first column.
+        '''
+        if openpyxl is None:
+            raise ImportError('openpyxl is needed to read excel files without Excel, pip install openpyxl')
+        book=openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            sheet=book[sheet_name]
+            if cell_range is not None:
+                min_col, min_row, max_col, max_row=openpyxl.utils.cell.range_boundaries(cell_range)
+                rows=sheet.iter_rows(min_row=min_row, max_row=max_row, min_col=min_col, max_col=max_col, values_only=True)
+                header=list(next(rows, ()))
+            else:
+                rows=sheet.iter_rows(min_row=1, values_only=True)
+                first_row=next(rows, ())
+                width=0
+                while width<len(first_row) and first_row[width] not in (None, ''):
+                    width+=1
+                header=list(first_row[:width])
+            
+            chunk=[]
+            yielded=False
+            for row in rows:
+                if cell_range is None:
+                    if len(row)==0 or row[0] in (None, ''):
+                        break
+                    row=tuple(row[:width])+(None,)*(width-len(row))
+                chunk.append(row)
+                if len(chunk)==chunk_size:
+                    yield pd.DataFrame.from_records(chunk, columns=header)
+                    yielded=True
+                    chunk=[]
+            #an empty sheet still gives one frame with the header
+            if chunk or not yielded:
+                yield pd.DataFrame.from_records(chunk, columns=header)
+        finally:
+            book.close()
+
+    @staticmethod
+    def folder_list(f_path:str, manifest:object=None) -> list:
     
-        '''This function grabs a list of folders at a given path'''
+        '''This function grabs a list of folders at a given path
+        manifest: optional Folder_manifest covering f_path, the list then comes from the manifest instead of the file system'''
+        
+        if manifest is not None:
+            return manifest.folders(f_path)
     
         sublist = []
 
@@ -317,29 +645,53 @@ class Sort_tools:
     
     @staticmethod
     def calculate_current_age_column(date_list:list)->list:
-        '''calculates a current age at runtime given a birth date column'''
-        ct = dt.datetime.now()
-        ages  = [ct - date for date in date_list]
-        ages_years = [round(pd.to_numeric(age.days)/365, 2) for age in ages]
-        return ages_years
+        '''calculates a current age at runtime given a birth date column
+        Uses calculate_age_column, call that directly for big columns or to get age at another date'''
+        ages_years = Sort_tools.calculate_age_column(date_list, dtype=np.float64).round(2)
+        return ages_years.tolist()
     
     @staticmethod
-    def remove_null_lines(df:object, non_numeric_keys:list)->object:
+    def calculate_age_column(birth_dates:object, reference:object=None, dtype:object=np.float32)->object:
+        '''
+        Vectorized age in years (whole days / 365, same as calculate_current_age_column but unrounded) 
+        birth_dates: birth date column (series, array or list of datetimes)
+        reference: date to measure age at. None for now, a single date, or a column the same length as birth_dates for 
+        a date per row, eg the scan date for age at scan
+        dtype: float32 by default to keep memory down
+        Returns a numpy array, NaN where either date is missing
+        '''
+        births=pd.to_datetime(pd.Series(birth_dates)).to_numpy().astype('datetime64[ns]')
+        if reference is None:
+            ref=np.datetime64(dt.datetime.now(), 'ns')
+        elif np.ndim(reference)==0:
+            ref=np.datetime64(pd.Timestamp(reference), 'ns')
+        else:
+            ref=pd.to_datetime(pd.Series(reference)).to_numpy().astype('datetime64[ns]')
+        days=np.floor((ref-births)/np.timedelta64(1, 'D'))
+        return (days/365).astype(dtype)
+    
+    @staticmethod
+    def remove_null_lines(df:object, non_numeric_keys:list, inplace:bool=False)->object:
         '''
         Filters out lines in a DataFrame in which all numeric fields are null, but leaves lines with only some null values
         df - the dataframe to filter
         non_numeric_keys: a list of the keys to exclude
+        inplace: if True the rows are dropped from df itself and the number removed is returned instead of a dataframe
+        Uses a single notna().any(axis=1) mask, so rows whose values sum to zero or less are kept. The number of lines
+        removed goes to the module logger.
         '''    
-        id_df = df[non_numeric_keys].copy()
-        numeric_df = df.drop(columns=non_numeric_keys)
-        row_sum = numeric_df.sum(axis=1)
-        numeric_df['row_sum']= row_sum.to_list()
-        numeric_df = numeric_df[numeric_df['row_sum']>0]
-        numeric_df = numeric_df.drop(columns=['row_sum'])
-        df = pd.merge(id_df, numeric_df, left_index=True, right_index=True, how='inner')
-        df = df.reset_index()
-        df = df.drop(columns=['index'])
-        print(f'{len(id_df)-len(df)} null lines removed')
+        numeric_keys=[key for key in df.keys() if key not in non_numeric_keys]
+        keep=df[numeric_keys].notna().any(axis=1).to_numpy()
+        removed=int(len(keep)-keep.sum())
+        logger.info(f'{removed} null lines removed')
+        if inplace==True:
+            #number the rows first so dropping by label is dropping by position, even if the index had repeats
+            df.reset_index(drop=True, inplace=True)
+            df.drop(index=np.flatnonzero(~keep), inplace=True)
+            df.reset_index(drop=True, inplace=True)
+            return removed
+        df=df.take(np.flatnonzero(keep))
+        df=df.reset_index(drop=True)
         return df
     
     @staticmethod
@@ -359,38 +711,133 @@ class Sort_tools:
         df: dataframe housing data for analysis
         count_keys: a list of keys from which the null count will be compiled
         ids: a list of keys, which should be excluded from null analysis, and passed into the output dataframe
+        The counting is done by null_profile
         '''
-        count_df=df[count_keys].copy()
-        #go through the keys - swap null for 1 and values for 0
-        for key in count_df.keys():
-            #convert values that aren't null to 0
-            value_zapper=count_df[key].isnull()
-            count_df[key]=count_df[key].where(value_zapper, 0)
-            count_df[key]=count_df[key].fillna(1)
-        
-        #comute a row sum for the rows of the dataframe
-        row_sum = count_df.sum(axis=1)
+        row_nulls, col_nulls=Sort_tools.null_profile(df, count_keys)
         output_frame=df[ids].copy()
-        output_frame['relevant_nulls']=row_sum.to_list()
+        output_frame['relevant_nulls']=row_nulls
         return output_frame
+
+    @staticmethod
+    def null_profile(df:object, count_keys:list=None, chunk_size:int=None)->tuple:
+        '''
+        Counts nulls per row and per column with one pass of the null mask over each column. The counts are added into a 
+        single int32 array as it goes, so nothing the size of the whole frame is ever made. Arrow backed columns get their 
+        mask from the validity bitmap.
+        df: dataframe to profile
+        count_keys: columns to count, all columns if None
+        chunk_size: if given, rows are processed this many at a time to keep the masks small
+        Returns a tuple, first is a numpy array of null counts per row, second is a series of null counts per column
+        '''
+        if count_keys is None:
+            count_keys=list(df.keys())
+        n=len(df)
+        if chunk_size is None or chunk_size<=0:
+            chunk_size=max(n, 1)
+        row_nulls=np.zeros(n, dtype=np.int32)
+        col_nulls=np.zeros(len(count_keys), dtype=np.int64)
+        for start in range(0, n, chunk_size):
+            stop=min(start+chunk_size, n)
+            for c, key in enumerate(count_keys):
+                mask=df[key].iloc[start:stop].isna().to_numpy()
+                row_nulls[start:stop]+=mask
+                col_nulls[c]+=mask.sum()
+        return (row_nulls, pd.Series(col_nulls, index=count_keys))
     
     @staticmethod
-    def lower_text_columns(df:object, column_list:list)->object:
+    def lower_text_columns(df:object, column_list:list, engine:str='vectorized', unique_ratio:float=0.5)->object:
         '''
         Lower the case of a string column in a dataframe
         Returns an identical dataframe to the one accepted, with listed string columns lowered in case
         df: a dataframe 
         column_list: list of columns for case lowering
+        engine: 'vectorized' (default) lowers with pandas string methods and leaves nulls alone. Categorical columns only have 
+        their categories lowered, and columns where the unique values are under unique_ratio of the rows are factorized so each
+        unique value is lowered once and mapped back. 'loop' is the original version, which fails on nulls.
+        unique_ratio: cutoff for treating a plain string column as low cardinality
         '''
+        if engine=='loop':
+            for column in column_list:
+                text_list=df[column].to_list()
+                new_list=[]
+                for text in text_list:
+                    new_text=text.lower()
+                    new_list.append(new_text)
+                df[column]=new_list
+            return df
+        elif engine!='vectorized':
+            raise ValueError(f"engine must be 'vectorized' or 'loop', got {engine}")
+        
         for column in column_list:
-            text_list=df[column].to_list()
-            new_list=[]
-            for text in text_list:
-                new_text=text.lower()
-                new_list.append(new_text)
-            df[column]=new_list
+            col=df[column]
+            if isinstance(col.dtype, pd.CategoricalDtype):
+                #lowering can merge categories, eg 'CT' and 'ct', so remap the codes onto the lowered set
+                lowered=col.cat.categories.str.lower()
+                new_cats=lowered.unique()
+                remap=np.append(new_cats.get_indexer(lowered), -1)
+                codes=remap[col.cat.codes.to_numpy()]
+                df[column]=pd.Categorical.from_codes(codes, categories=new_cats, ordered=col.cat.ordered)
+                continue
+            codes, uniques=pd.factorize(col)
+            if len(uniques)<unique_ratio*len(col):
+                lowered=np.append(pd.Index(uniques).str.lower().to_numpy(dtype=object), np.nan)
+                df[column]=pd.Series(lowered[codes], index=col.index, dtype=col.dtype)
+            else:
+                df[column]=col.str.lower()
         return df
     
+    @staticmethod
+    def optimize_dtypes(df:object, category_ratio:float=0.5, overrides:dict=None, downcast:bool=True, 
+                        categorize:bool=True, parse_dates:bool=True)->object:
+        '''
+        Shrinks a dataframe's memory by picking tighter dtypes column by column. Returns a new dataframe.
+        downcast: integers go to the smallest integer type that holds them, floats go to float32 only when no value changes
+        categorize: string columns with fewer unique values than category_ratio of the rows become categorical
+        parse_dates: string columns where every value is a dashed ISO date (eg 2020-01-31 or 2020-01-31 08:30) become 
+        datetime64. Compact forms like 20200131 or 2020 are left alone, they are usually codes or ids, use overrides for those
+        overrides: {column: dtype} applied instead of the automatic choice, 'datetime64' parses dates
+        '''
+        overrides=overrides if overrides is not None else {}
+        #yyyy-mm-dd with an optional time after a space or T
+        iso_date=r'\d{4}-\d{2}-\d{2}(?:[ T]\d{2}:\d{2}.*)?'
+        out_cols={}
+        for key in df.keys():
+            col=df[key]
+            if key in overrides:
+                dtype=overrides[key]
+                if isinstance(dtype, str) and dtype.startswith('datetime64'):
+                    col=pd.to_datetime(col)
+                    if dtype!='datetime64':
+                        col=col.astype(dtype)
+                else:
+                    col=col.astype(dtype)
+            elif pd.api.types.is_bool_dtype(col.dtype):
+                pass
+            elif pd.api.types.is_integer_dtype(col.dtype) and downcast:
+                col=pd.to_numeric(col, downcast='integer')
+            elif pd.api.types.is_float_dtype(col.dtype) and downcast:
+                small=col.astype(np.float32)
+                if (small.astype(col.dtype)==col)[col.notna()].all():
+                    col=small
+            elif pd.api.types.is_object_dtype(col.dtype) or pd.api.types.is_string_dtype(col.dtype):
+                values=col.dropna()
+                parsed=None
+                if parse_dates and len(values)>0 and values.map(type).eq(str).all():
+                    #check a sample first so text columns fail fast
+                    sample=values.iloc[:1000]
+                    if (sample.str.fullmatch(iso_date).all()
+                            and values.str.fullmatch(iso_date).all()
+                            and pd.to_datetime(sample, format='ISO8601', errors='coerce').notna().all()):
+                        parsed=pd.to_datetime(col, format='ISO8601', errors='coerce')
+                        if parsed.notna().sum()!=len(values):
+                            parsed=None
+                if parsed is not None:
+                    col=parsed
+                elif categorize and col.nunique()<category_ratio*len(col):
+                    col=col.astype('category')
+            out_cols[key]=col
+        return pd.DataFrame(out_cols, index=df.index)
+    
     @staticmethod
     def construct_longitudinal_df(interval_df:object, 
                               merge_df:object,
@@ -399,7 +846,8 @@ class Sort_tools:
                               diameter_key:str,
                               ct_count:int, 
                               strict_count_match:bool,
-                              always_use_last_date:bool)->object:
+                              always_use_last_date:bool,
+                              mode:str='merge')->object:
         '''
         Constructs a dataframe with multiple dates and diameters per patient id
     
@@ -423,12 +871,25 @@ class Sort_tools:
         chronologically. This is only relevant if strict_count_match==False. Can be used for longest intervals if ct_count==2
         and strict_count_match==False
     
+        mode: 'merge' (default) pulls the nth date out of every list and does one merge per ct. 'pivot' ranks the scans once, 
+        joins the measurements once on (id, date) and reshapes to the wide columns in one step, which is much faster for big
+        ct_counts. The output is the same. Pivot needs one diameter per (id, date) in merge_df, if there are more it falls back to merge.
+    
         Returns: a dataframe with numbered date and diameter columns by patient id
         '''
         if strict_count_match==True:
             rel_df=interval_df[interval_df.date_count==ct_count]
         else:
             rel_df=interval_df[interval_df.date_count>=ct_count]
+
+        if mode=='pivot':
+            pivot_df=Sort_tools._longitudinal_pivot(rel_df, merge_df, merge_date_key, id_key, diameter_key, ct_count, always_use_last_date)
+            if pivot_df is not None:
+                print(f'Product dataframe length: {len(pivot_df)}')
+                return pivot_df
+            print('More than one measurement per id and date, falling back to merge mode')
+        elif mode!='merge':
+            raise ValueError(f"mode must be 'merge' or 'pivot', got {mode}")
         
         date_lists=rel_df['unique_date_list'].to_list()
     
@@ -478,25 +939,88 @@ class Sort_tools:
         return rel_df
     
     @staticmethod
-    def remove_multiple_instance(df:object, id_key:str, date_key:str, num_key:str)->object:
+    def _longitudinal_pivot(rel_df:object, merge_df:object, merge_date_key, id_key:str, diameter_key:str, ct_count:int, 
+                            always_use_last_date:bool)->object:
+        '''
+        Single join version of construct_longitudinal_df used for mode='pivot'. Returns None when merge_df has more than one
+        diameter for an (id, date), because the merge version makes every combination of those and a pivot can't.
+        '''
+        mdf=merge_df[[id_key, merge_date_key, diameter_key]].drop_duplicates()
+        mdf[merge_date_key]=pd.to_datetime(mdf[merge_date_key])
+        if mdf.duplicated(subset=[id_key, merge_date_key]).any():
+            return None
+
+        #one row per date, with its position in the patient's list
+        dates=rel_df['unique_date_list'].reset_index(drop=True).explode()
+        row_num=dates.index.to_numpy()
+        position=dates.groupby(level=0).cumcount().to_numpy()
+        list_len=np.bincount(row_num, minlength=len(rel_df))[row_num]
+
+        #slot n keeps the nth date, the last slot can take the end of the list instead
+        last_pos=list_len-1 if always_use_last_date==True else ct_count-1
+        slot=np.where(position<ct_count-1, position+1, 0)
+        slot=np.where(position==last_pos, ct_count, slot)
+        keep=slot>0
+
+        long_df=pd.DataFrame({
+            'row_num':row_num[keep],
+            'slot':slot[keep],
+            id_key:rel_df[id_key].to_numpy()[row_num[keep]],
+            merge_date_key:pd.to_datetime(dates.to_numpy()[keep])
+        })
+        long_df=pd.merge(long_df, mdf, on=[id_key, merge_date_key], how='inner')
+
+        #only patients with a diameter for every slot make it through the merge version
+        found=long_df.groupby('row_num')['slot'].transform('size')
+        long_df=long_df[found==ct_count]
+
+        #pivot dates and diameters separately so each keeps its dtype
+        slots=range(1, ct_count+1)
+        wide_dates=long_df.pivot(index='row_num', columns='slot', values=merge_date_key).reindex(columns=slots)
+        wide_diams=long_df.pivot(index='row_num', columns='slot', values=diameter_key).reindex(columns=slots)
+        out_df=pd.DataFrame({id_key:rel_df[id_key].to_numpy()[wide_dates.index.to_numpy()]})
+        for n in slots:
+            out_df[f'ct_date_{n}']=wide_dates[n].to_numpy()
+        for n in slots:
+            out_df[f'{diameter_key}_{n}']=wide_diams[n].to_numpy()
+        out_df=out_df.drop_duplicates()
+        return out_df
+    
+    @staticmethod
+    def remove_multiple_instance(df:object, id_key:str, date_key:str, num_key:str, return_mask:bool=False)->object:
         '''
         Removes multiple instances from a dataframe. It's specific to cases where one instance is expected.
         id_key and date_key are two keys for a groupby calculation, they can be any two keys. 
         num key is a third key that will be used for dertermining multiplicity.
         This can be used with longitudinal dfs after they are created.
+        An id is kept if at least one of its (id_key, date_key) groups has exactly one non null num_key, the same rule as 
+        before, but it's done with group sizes and one boolean mask instead of merging the ids back in. Each row is kept once.
+        return_mask: if True return the boolean mask of kept rows instead of a dataframe
+        Counts go to the module logger.
         '''
-        group_encs=df[[id_key, date_key, num_key]].copy()
-        group_encs=group_encs.groupby([id_key, date_key]).count()
-        group_encs=group_encs.reset_index()
-        init_len=len(group_encs)
-        print(f'Found {init_len} unique keys')
-        group_encs=group_encs[group_encs[num_key]==1]
-        fin_len=len(group_encs)
-        d_len=init_len-fin_len
-        print(f'removed {d_len} for multiple instance')
-        id_cut=group_encs[[id_key]].copy()
-        cut_df=pd.merge(df, id_cut, on=id_key, how='inner')
-        print(f'final df contains {len(cut_df)} lines')
+        n=len(df)
+        #hash based group numbers, ngroup gives NaN where a key is null (groupby drops those), -1 here
+        group_num=df.groupby([id_key, date_key], sort=False).ngroup().fillna(-1).to_numpy(dtype=np.int64)
+        in_group=group_num>=0
+        group_count=np.bincount(group_num[in_group], weights=df[num_key].notna().to_numpy()[in_group], 
+                                minlength=int(group_num.max())+1 if n>0 else 0)
+        logger.info(f'Found {len(group_count)} unique keys')
+        single=group_count==1
+        logger.info(f'removed {len(group_count)-int(single.sum())} for multiple instance')
+        
+        #broadcast back to rows, then to ids
+        row_single=np.zeros(n, dtype=bool)
+        row_single[in_group]=single[group_num[in_group]]
+        id_num, id_uniques=pd.factorize(df[id_key])
+        has_id=id_num>=0
+        id_ok=np.bincount(id_num[has_id], weights=row_single[has_id], minlength=len(id_uniques))>0
+        mask=np.zeros(n, dtype=bool)
+        mask[has_id]=id_ok[id_num[has_id]]
+        
+        logger.info(f'final df contains {int(mask.sum())} lines')
+        if return_mask:
+            return mask
+        cut_df=df[mask].reset_index(drop=True)
         return cut_df
     
     @staticmethod
@@ -513,51 +1037,34 @@ class Sort_tools:
         returns the input dataframes with sequentially numbered delta, interval (years), and rate fields
         '''
     
-        #get date and diameter key lists
-        date_keys=[key for key in df.keys() if date_string_stem in key]
-        diameter_keys=[key for key in df.keys() if diameter_string_stem in key]
-    
-        #calculate deltas
-        for n, diameter in enumerate(diameter_keys):
-            d_key_comps=diameter.split('_')
-            diameter_num=d_key_comps[-1]
-            if int(diameter_num)==len(diameter_keys):
-                break
-            delta_key=f'delta_{diameter_num}'
-            d_key_comps.pop(-1)
-            diam_stem='_'.join(d_key_comps)
-            diam1=f'{diam_stem}_{int(diameter_num)+1}'
-            df[delta_key]=df[diam1]-df[diameter]
-        
-        #calculate intervals
-        for n, date in enumerate(date_keys):
-            da_key_comps=date.split('_')
-            date_num=da_key_comps[-1]
-            if int(date_num)==len(date_keys):
-                break
-            interval_key=f'interval_{date_num}'
-            da_key_comps.pop(-1)
-            date_stem='_'.join(da_key_comps)
-            date1=f'{date_stem}_{int(date_num)+1}'
-            df[interval_key]=(df[date1]-df[date])/pd.Timedelta(days=365)
-        
-        #get delta and interval keys
-        deltas=[key for key in df.keys() if 'delta' in key]
-        intervals=[key for key in df.keys() if 'interval' in key]
-        deltas.sort()
-        intervals.sort()
-        assert len(deltas)==len(intervals), 'column numbers should match'
-    
-        #calculate rates
-        for d, i in zip(deltas, intervals):
-            rate_num=d.split('_')[-1]
-            rate_key=f'rate_{rate_num}'
-            df[rate_key]=df[d]/df[i]
+        #get date and diameter key lists, ordered by their number so 10 comes after 9
+        suffix=lambda key: int(key.split('_')[-1])
+        date_keys=sorted([key for key in df.keys() if date_string_stem in key], key=suffix)
+        diameter_keys=sorted([key for key in df.keys() if diameter_string_stem in key], key=suffix)
+        assert len(date_keys)==len(diameter_keys), 'column numbers should match'
+        
+        #gather into 2d blocks, one column per timepoint
+        date_block=np.column_stack([df[key].to_numpy().astype('datetime64[ns]') for key in date_keys])
+        diameter_block=df[diameter_keys].to_numpy()
+        
+        #deltas and intervals between neighbouring timepoints, then rates, all in one go
+        deltas=np.diff(diameter_block, axis=1)
+        intervals=np.diff(date_block, axis=1)/np.timedelta64(365, 'D')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rates=deltas/intervals
+        
+        nums=[key.split('_')[-1] for key in diameter_keys[:-1]]
+        new_cols=pd.concat([
+            pd.DataFrame(deltas, index=df.index, columns=[f'delta_{n}' for n in nums]),
+            pd.DataFrame(intervals, index=df.index, columns=[f'interval_{n}' for n in nums]),
+            pd.DataFrame(rates, index=df.index, columns=[f'rate_{n}' for n in nums])
+        ], axis=1)
+        df=pd.concat([df, new_cols], axis=1)
         
         return df
     
     @staticmethod
-    def prune_tight_dates(df:object, id_key:str,  date_key:str, space_factor:int)->object:
+    def prune_tight_dates(df:object, id_key:str,  date_key:str, space_factor:int, engine:str='scan', return_mask:bool=False)->object:
         '''
         This function is for sampling closely spaced time series data. It accepts a dataframe with an id key and date key along with a spacing factor in 
         days. The function aggregates dates by the id key, and removes dates subsequent to the first that are within the spacing factor, resetting when the
@@ -566,7 +1073,15 @@ class Sort_tools:
         df - the dataframe to be spaced
         id_key - an ID to which dates are subordinate
         date_key - the date key containing dates to be spaced. Dates should be pretyped to datetime64
+        engine - 'scan' (default) sorts once and runs the spacing rule on int64 day arrays for all ids at the same time. 'loop' is the
+        original list based version. Both return the same rows for dates without nulls, the scan engine drops rows with a 
+        null date.
+        return_mask - if True return a boolean array lined up with the rows of df (True = kept) instead of a new dataframe. Only for the scan engine.
         '''
+        if engine=='scan':
+            return Sort_tools._prune_tight_dates_scan(df, id_key, date_key, space_factor, return_mask)
+        elif engine!='loop':
+            raise ValueError(f"engine must be 'scan' or 'loop', got {engine}")
         
         #get only useful fields
         use_df=df[[id_key, date_key]].copy()
@@ -614,7 +1129,58 @@ class Sort_tools:
         return return_df
     
     @staticmethod
-    def calculate_date_intervals(df:object, id_key:str, date_key:str, longest_int:bool)->object:
+    def _prune_tight_dates_scan(df:object, id_key:str, date_key:str, space_factor:int, return_mask:bool)->object:
+        '''
+        Array version of prune_tight_dates. A date is kept when the days since the last kept date in its id (summed from the 
+        whole day gaps, same as the loop) exceed space_factor. Day positions are laid out on one increasing axis with a gap 
+        bigger than space_factor between ids, so every id can jump to its next kept date with the same searchsorted call.
+        The number of passes is the most dates kept for any one id, not the number of rows.
+        '''
+        use_df=df[[id_key, date_key]].copy()
+        use_df['row_pos']=np.arange(len(use_df))
+        #groupby drops null ids in the loop version, so drop them here too. Null dates have no place on the day axis 
+        #(NaT gaps would come out as garbage ints and break the searchsorted), so they are dropped as well
+        use_df=use_df[use_df[id_key].notna() & use_df[date_key].notna()]
+        use_df=use_df.sort_values(by=[id_key, date_key])
+        ids=use_df[id_key].to_numpy()
+        dates=use_df[date_key].to_numpy()
+        n=len(ids)
+
+        starts=Sort_tools._group_starts(ids)
+        ends=np.append(starts[1:], n)
+        #whole day gaps between neighbours, floored like timedelta.days
+        gaps=np.zeros(n, dtype=np.int64)
+        if n>1:
+            gaps[1:]=(dates[1:]-dates[:-1])//np.timedelta64(1, 'D')
+        gaps[starts]=int(space_factor)+1 if space_factor>=0 else 1
+        axis=np.cumsum(gaps)
+
+        kept=np.zeros(n, dtype=bool)
+        pointer=starts.copy()
+        group_end=ends
+        while len(pointer)>0:
+            kept[pointer]=True
+            nxt=np.searchsorted(axis, axis[pointer]+space_factor, side='right')
+            #a negative space_factor keeps everything, so always move forward at least one
+            nxt=np.maximum(nxt, pointer+1)
+            active=nxt<group_end
+            pointer=nxt[active]
+            group_end=group_end[active]
+
+        if return_mask:
+            mask=np.zeros(len(df), dtype=bool)
+            mask[use_df['row_pos'].to_numpy()[kept]]=True
+            print(f'{len(df)-kept.sum()} removed for close proximity to most recent value')
+            return mask
+
+        return_df=use_df.loc[:, [id_key, date_key]][kept].reset_index(drop=True)
+        torched_enc=len(df)-len(return_df)
+        print(f'{torched_enc} removed for close proximity to most recent value')
+        print(f'{len(return_df)} remain in the product dataframe')
+        return return_df
+    
+    @staticmethod
+    def calculate_date_intervals(df:object, id_key:str, date_key:str, longest_int:bool, engine:str='columnar', interval_labels:bool=True)->object:
         '''
         Calculate time intervals for a cohort. This function aggregates dates on a single patient Id and then calculates combinations in the form 
         id_d1_d2, id_d2_d3... id_dn_dn+1. A longest inerval is available as an option. a disaggregated dataframe is returned with id, time1, time2, 
@@ -623,7 +1189,14 @@ class Sort_tools:
         id_key: the string name of the id_column
         date_key: date column
         longest int: a boolean value, True if longest intervals should be calculated. 
+        engine: 'columnar' (default) sorts once and pairs each row with the next one in its id using shifted arrays. 'loop' is the original version.
+        interval_labels: if False the id_d1_d2 'interval' column is skipped, which is the only string work left. Columnar engine only.
         '''
+        if engine=='columnar':
+            return Sort_tools._calculate_date_intervals_columnar(df, id_key, date_key, longest_int, interval_labels)
+        elif engine!='loop':
+            raise ValueError(f"engine must be 'columnar' or 'loop', got {engine}")
+
         grp_df=df[[id_key, date_key]].copy()
         grp_df=grp_df.groupby(id_key).agg(
             dates=pd.NamedAgg(column=date_key, aggfunc=list)
@@ -671,6 +1244,532 @@ class Sort_tools:
         return_df=pd.DataFrame({id_key:pt_id, 'date1':date1, 'date2':date2, 'interval':intervals, 'interval_length_yrs':interval_length})
         return return_df 
 
+    @staticmethod
+    def _calculate_date_intervals_columnar(df:object, id_key:str, date_key:str, longest_int:bool, interval_labels:bool)->object:
+        '''
+        Columnar version of calculate_date_intervals. Rows come out in the same order as the loop: ids in sorted order, 
+        consecutive intervals by date, then the longest interval for that id.
+        '''
+        use_df=df[[id_key, date_key]]
+        use_df=use_df[use_df[id_key].notna()]
+        use_df=use_df.sort_values(by=[id_key, date_key], kind='stable')
+        ids=use_df[id_key].to_numpy()
+        dates=use_df[date_key].to_numpy()
+        n=len(ids)
+
+        starts=Sort_tools._group_starts(ids)
+        ends=np.append(starts[1:], n)
+        group_num=np.repeat(np.arange(len(starts)), ends-starts)
+
+        #pair every row with the next row when it is in the same id
+        first_pos=np.flatnonzero(group_num[:-1]==group_num[1:]) if n>1 else np.zeros(0, dtype=np.int64)
+        second_pos=first_pos+1
+        row_group=group_num[first_pos]
+        row_kind=np.zeros(len(first_pos), dtype=np.int8)
+
+        if longest_int==True:
+            long_groups=np.flatnonzero((ends-starts)>2)
+            first_pos=np.concatenate([first_pos, starts[long_groups]])
+            second_pos=np.concatenate([second_pos, ends[long_groups]-1])
+            row_group=np.concatenate([row_group, long_groups])
+            row_kind=np.concatenate([row_kind, np.ones(len(long_groups), dtype=np.int8)])
+            #stable sort puts each longest interval after the consecutive ones for its id
+            order=np.lexsort((row_kind, row_group))
+            first_pos=first_pos[order]
+            second_pos=second_pos[order]
+
+        date1=use_df[date_key].iloc[first_pos].reset_index(drop=True)
+        date2=use_df[date_key].iloc[second_pos].reset_index(drop=True)
+        return_df=pd.DataFrame({id_key:ids[first_pos], 'date1':date1, 'date2':date2})
+        if interval_labels==True:
+            return_df['interval']=(return_df[id_key].astype(str)+'_'
+                                   +date1.dt.strftime('%Y%m%d')+'_'
+                                   +date2.dt.strftime('%Y%m%d'))
+        return_df['interval_length_yrs']=((date2-date1)/pd.Timedelta(days=365)).round(2)
+        return return_df
+
+class Column_profiler:
+    '''
+    One pass column profiles behind find_unique, print_unique and count_groups. For each column it keeps the value counts 
+    (hash based, unsorted, nulls included), the number of distinct values and the number of nulls. Profiles are cached 
+    against the dataframe object and a fingerprint of its shape, columns, dtypes and a sample of rows, so calling again on 
+    the same df is instant. Editing single cells in place may not change the fingerprint, call clear() after doing that.
+    The Sort_tools wrappers only use the cache when called with cached=True.
+    For very high cardinality columns approximate=True skips the value counts and gives a HyperLogLog distinct count.
+
+    profiles=Column_profiler.profile(df, ['sex', 'race', 'mrn'])
+    profiles['sex']['value_counts']
+    '''
+    cache={}
+    sample_rows=1000
+    hll_precision=14
+
+    @staticmethod
+    def fingerprint(df:object)->tuple:
+        step=max(len(df)//Column_profiler.sample_rows, 1)
+        sample=df.iloc[::step]
+        try:
+            sample_hash=int(pd.util.hash_pandas_object(sample, index=True).sum())
+        except TypeError:
+            #unhashable values like lists, fall back to the shape only
+            sample_hash=None
+        return (df.shape, tuple(df.keys()), tuple(str(d) for d in df.dtypes), sample_hash)
+
+    @staticmethod
+    def frame_cache(df:object)->dict:
+        '''The column profile dict for this df, emptied if the df has changed or a different df took over the id'''
+        entry=Column_profiler.cache.get(id(df))
+        fingerprint=Column_profiler.fingerprint(df)
+        if entry is None or entry[0]() is not df or entry[1]!=fingerprint:
+            #drop entries for frames that no longer exist
+            for key in [k for k, v in Column_profiler.cache.items() if v[0]() is None]:
+                del Column_profiler.cache[key]
+            entry=(weakref.ref(df), fingerprint, {})
+            Column_profiler.cache[id(df)]=entry
+        return entry[2]
+
+    @staticmethod
+    def profile(df:object, columns:list, approximate:bool=False, cached:bool=True)->dict:
+        '''
+        Returns {column: {'value_counts':..., 'distinct':..., 'nulls':...}} for the listed columns.
+        With approximate=True, value_counts is None and distinct is a HyperLogLog estimate.
+        With cached=False the profiles are worked out fresh and not kept.
+        '''
+        frame_cache=Column_profiler.frame_cache(df) if cached else {}
+        out={}
+        for key in columns:
+            cache_key=(key, approximate)
+            if cache_key not in frame_cache:
+                col=df[key]
+                nulls=int(col.isna().sum())
+                if approximate==True:
+                    frame_cache[cache_key]={'value_counts':None, 'distinct':Column_profiler.hll_distinct(col), 'nulls':nulls}
+                else:
+                    counts=col.value_counts(sort=False, dropna=False)
+                    frame_cache[cache_key]={'value_counts':counts, 'distinct':int(counts.index.notna().sum()), 'nulls':nulls}
+            out[key]=frame_cache[cache_key]
+        return out
+
+    @staticmethod
+    def hll_distinct(col:object)->int:
+        '''HyperLogLog estimate of the number of distinct non null values in a column'''
+        p=Column_profiler.hll_precision
+        m=2**p
+        hashes=pd.util.hash_pandas_object(col.dropna(), index=False).to_numpy()
+        registers=np.zeros(m, dtype=np.int64)
+        if len(hashes)>0:
+            bucket=(hashes>>np.uint64(64-p)).astype(np.int64)
+            #rank is the position of the first 1 bit after the bucket bits, from the top 32 of the remaining bits
+            rest=((hashes<<np.uint64(p))>>np.uint64(32)).astype(np.float64)
+            rank=np.where(rest>0, 32-np.floor(np.log2(np.maximum(rest, 1))), 33).astype(np.int64)
+            np.maximum.at(registers, bucket, rank)
+        alpha=0.7213/(1+1.079/m)
+        estimate=alpha*m*m/np.sum(2.0**-registers)
+        zeros=int((registers==0).sum())
+        if estimate<=2.5*m and zeros>0:
+            estimate=m*np.log(m/zeros)
+        return int(round(estimate))
+
+    @staticmethod
+    def clear():
+        Column_profiler.cache.clear()
+
+
+class Key_registry:
+    '''
+    A persistent surrogate key table for unique_val_table. Rows are hashed to 128 bits and the hash -> key pairs are kept 
+    in a folder of parquet part files. The first 64 bits are the pandas hash_pandas_object row hash. For the second, each 
+    column is hashed with a different hash key, salted with a per column constant and hashed again before the columns are 
+    combined, so the two halves are independent for numeric columns as well as strings. A row is known by its hash alone, 
+    at 128 bits the chance of two different rows sharing one is negligible even over billions of rows (a 64 bit hash would 
+    not be safe at that size). Two distinct rows of a batch hashing the same raise an error. 
+    Each batch that adds new rows writes one small part file, sorted by hash, with only the new pairs, so adding a daily 
+    batch costs time in proportion to the batch, not the history. Keys start at 1 and never change once given out.
+    Keep the column dtypes the same between batches, 1 and 1.0 hash differently.
+
+    registry=Key_registry('path/to/registry')
+    keyed_df=Sort_tools.unique_val_table(batch_df, 'person_key', registry=registry)
+    '''
+    #hash key for the second half of the row hash, pandas uses its default for the first
+    second_hash_key='key_registry_2nd'
+    #bumped whenever the row hash changes, part files from another version can't be read
+    hash_version='2'
+
+    def __init__(self, root_path):
+        self.root=root_path
+        os.makedirs(self.root, exist_ok=True)
+        #each run is a (sorted hashes, keys) pair from one part file, hashes are 16 byte strings
+        self.runs=[]
+        self.columns=None
+        self.next_key=1
+        self.load()
+
+    def part_files(self):
+        return sorted([os.path.join(self.root, f) for f in os.listdir(self.root) if f.startswith('part-') and f.endswith('.parquet')])
+
+    def load(self):
+        for part in self.part_files():
+            table=pq.read_table(part)
+            metadata=table.schema.metadata or {}
+            if metadata.get(b'hash_version', b'').decode()!=Key_registry.hash_version:
+                raise ValueError(f'{part} was written with an older row hash, the registry needs to be rebuilt')
+            if self.columns is None and b'columns' in metadata:
+                self.columns=json.loads(metadata[b'columns'])
+            hashes=self.combine_hashes(table['row_hash'].to_numpy(), table['row_hash2'].to_numpy())
+            #part files are written sorted
+            self.add_run(hashes, table['key'].to_numpy(), is_sorted=True)
+
+    def add_run(self, hashes:object, keys:object, is_sorted:bool=False):
+        if not is_sorted:
+            order=np.argsort(hashes, kind='stable')
+            hashes=hashes[order]
+            keys=keys[order]
+        self.runs.append((hashes, keys))
+        if len(keys)>0:
+            self.next_key=max(self.next_key, int(keys.max())+1)
+
+    @staticmethod
+    def combine_hashes(hashes1:object, hashes2:object)->object:
+        '''Two uint64 hash arrays as one array of 16 byte strings, which sort and compare as 128 bit values'''
+        pairs=np.stack([hashes1, hashes2], axis=1).astype('>u8')
+        return np.ascontiguousarray(pairs).view('S16').ravel()
+
+    @staticmethod
+    def split_hashes(hashes:object)->tuple:
+        pairs=hashes.view('>u8').reshape(-1, 2).astype(np.uint64)
+        return (pairs[:, 0], pairs[:, 1])
+
+    def hash_rows(self, df:object)->object:
+        rows=df[self.columns]
+        hashes1=pd.util.hash_pandas_object(rows, index=False).to_numpy()
+        #hash_key only changes the hash of strings, numbers hash the same with any key. Salting each column hash with its 
+        #own constant and hashing it again makes the second half a different function of the row for every dtype
+        salted={}
+        for i, key in enumerate(self.columns):
+            col_hash=pd.util.hash_pandas_object(rows[key], index=False, hash_key=Key_registry.second_hash_key).to_numpy()
+            salt=np.uint64((0x9E3779B97F4A7C15*(i+1)) % 2**64)
+            salted[i]=pd.util.hash_array(col_hash^salt)
+        hashes2=pd.util.hash_pandas_object(pd.DataFrame(salted), index=False).to_numpy()
+        return self.combine_hashes(hashes1, hashes2)
+
+    def lookup(self, hashes:object)->object:
+        '''Returns the key for each hash, 0 where the hash isn't registered'''
+        keys=np.zeros(len(hashes), dtype=np.int64)
+        if len(hashes)==0:
+            return keys
+        for run_hashes, run_keys in self.runs:
+            if len(run_hashes)==0:
+                continue
+            pos=np.searchsorted(run_hashes, hashes)
+            pos=np.minimum(pos, len(run_hashes)-1)
+            found=run_hashes[pos]==hashes
+            keys[found]=run_keys[pos[found]]
+        return keys
+
+    def write_part(self, hashes:object, keys:object, part_num:int):
+        '''Writes sorted hashes and their keys as a part file'''
+        hashes1, hashes2=self.split_hashes(hashes)
+        table=pa.table({'row_hash':pa.array(hashes1, type=pa.uint64()), 'row_hash2':pa.array(hashes2, type=pa.uint64()), 
+                        'key':pa.array(keys, type=pa.int64())})
+        table=table.replace_schema_metadata({'columns':json.dumps(self.columns), 'hash_version':Key_registry.hash_version})
+        pq.write_table(table, os.path.join(self.root, f'part-{part_num:05d}.parquet'))
+
+    def assign(self, df:object, id_string:str)->object:
+        '''
+        Drops duplicate rows from df and adds an id_string column with each row's key, registering any rows that are new
+        '''
+        df=df.drop_duplicates()
+        df=df.reset_index(drop=True)
+        if self.columns is None:
+            self.columns=list(df.keys())
+        elif set(self.columns)!=set(df.keys()):
+            raise ValueError(f'registry was built on columns {self.columns}, got {list(df.keys())}')
+        hashes=self.hash_rows(df)
+        if len(np.unique(hashes))!=len(hashes):
+            #rows are distinct after drop_duplicates, so a repeated hash is a collision
+            raise ValueError('two different rows have the same row hash, keys cannot be assigned safely')
+        keys=self.lookup(hashes)
+        new_rows=keys==0
+        new_count=int(new_rows.sum())
+        if new_count>0:
+            keys[new_rows]=np.arange(self.next_key, self.next_key+new_count)
+            parts=self.part_files()
+            part_num=int(os.path.basename(parts[-1])[5:10])+1 if parts else 0
+            self.add_run(hashes[new_rows], keys[new_rows])
+            self.write_part(*self.runs[-1], part_num)
+        logger.info(f'{new_count} new keys registered, {len(df)-new_count} existing keys reused')
+        df[id_string]=keys
+        return df
+
+    def compact(self):
+        '''Merges all the part files into one, which keeps lookups fast after many small batches'''
+        if len(self.runs)<2:
+            return
+        hashes=np.concatenate([run[0] for run in self.runs])
+        keys=np.concatenate([run[1] for run in self.runs])
+        old_parts=self.part_files()
+        part_num=int(os.path.basename(old_parts[-1])[5:10])+1
+        self.runs=[]
+        self.add_run(hashes, keys)
+        self.write_part(*self.runs[-1], part_num)
+        for part in old_parts:
+            os.remove(part)
+
+
+class Key_translator:
+    '''
+    A reusable version of the translator table in switcheroo_v3. The hash index on the old key is built once, and after 
+    that swapping keys on a frame is one lookup and a take per column instead of a full merge. Gives the same result 
+    as switcheroo_v3, keys missing from the translator get nulls just like the right join.
+
+    translator=Key_translator(mrn_to_study_df, 'mrn')
+    df=translator.translate(df)
+    '''
+    def __init__(self, translate_df:object, target_key:str):
+        self.translate_df=translate_df
+        self.target_key=target_key
+        self.index=pd.Index(translate_df[target_key])
+        self.unique=self.index.is_unique
+        #columns in the order the merge would put them, without the old key
+        self.value_df=translate_df.drop(columns=[target_key])
+
+    def positions(self, key_col:object)->object:
+        '''Row of the translator for each key, -1 where there isn't one'''
+        if isinstance(key_col.dtype, pd.CategoricalDtype):
+            #look the categories up once and spread them out with the codes
+            cat_pos=np.append(self.index.get_indexer(key_col.cat.categories), -1)
+            return cat_pos[key_col.cat.codes.to_numpy()]
+        return self.index.get_indexer(key_col)
+
+    def translate(self, target_df:object)->object:
+        '''Swaps target_key in target_df for the translator's other columns'''
+        if not self.unique:
+            #a key that maps to more than one row multiplies rows, leave that to the merge
+            target_df=pd.merge(self.translate_df, target_df, on=self.target_key, how='right')
+            return target_df.drop(columns=[self.target_key])
+        pos=self.positions(target_df[self.target_key])
+        out_cols={}
+        for key in self.value_df.keys():
+            out_cols[key]=pd.api.extensions.take(self.value_df[key].array, pos, allow_fill=True)
+        out_df=pd.DataFrame(out_cols)
+        rest_df=target_df.drop(columns=[self.target_key]).reset_index(drop=True)
+        #names in both frames get the merge's _x and _y suffixes
+        overlap=[key for key in out_df.keys() if key in rest_df.keys()]
+        if overlap:
+            out_df=out_df.rename(columns={key:f'{key}_x' for key in overlap})
+            rest_df=rest_df.rename(columns={key:f'{key}_y' for key in overlap})
+        return pd.concat([out_df, rest_df], axis=1)
+
+    def translate_chunks(self, chunks:object):
+        '''Translates an iterable of frames, eg pd.read_csv(..., chunksize=n), one chunk at a time'''
+        for chunk in chunks:
+            yield self.translate(chunk)
+
+
+class Folder_manifest:
+    '''
+    A recursive listing of a folder tree that is built once and then kept up to date cheaply. Every folder's entries are 
+    recorded with name, size and mtime. The first walk runs the top level branches in parallel threads. On refresh only the 
+    folders whose own mtime has changed are listed again (a folder's mtime changes when entries are added, removed or 
+    renamed, not when a file inside is edited). If manifest_path is given the manifest is saved there as json and picked 
+    up again next time, so later sessions only pay for the stat calls.
+
+    manifest=Folder_manifest('path/to/data', manifest_path='path/to/data_manifest.json')
+    Sort_tools.folder_list('path/to/data/sub', manifest=manifest)
+    '''
+    def __init__(self, root_path, manifest_path=None, workers=8):
+        self.root=os.path.abspath(root_path)
+        self.manifest_path=manifest_path
+        self.workers=workers
+        #relative folder path -> {'mtime':..., 'entries':{name:[is_dir, size, mtime]}}
+        self.dirs={}
+        if manifest_path is not None and os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                saved=json.load(f)
+            if saved.get('root')==self.root:
+                self.dirs=saved['dirs']
+        self.refresh()
+
+    def rel(self, path):
+        '''Manifest key for a folder path, relative paths are taken from the current directory like os.listdir'''
+        rel_path=os.path.relpath(os.path.abspath(path), self.root)
+        if rel_path==os.pardir or rel_path.startswith(os.pardir+os.sep):
+            raise ValueError(f'{path} is outside the manifest root {self.root}')
+        return rel_path
+
+    def record(self, path):
+        if path is None:
+            path=self.root
+        rel_path=self.rel(path)
+        if rel_path not in self.dirs:
+            raise FileNotFoundError(f'{path} is not a folder in the manifest for {self.root}, call refresh() if it is new')
+        return self.dirs[rel_path]
+
+    def scan_dir(self, rel_path):
+        '''Lists one folder, returns its record'''
+        full_path=os.path.join(self.root, rel_path)
+        entries={}
+        with os.scandir(full_path) as it:
+            for entry in it:
+                stat=entry.stat(follow_symlinks=False)
+                entries[entry.name]=[entry.is_dir(follow_symlinks=False), stat.st_size, stat.st_mtime]
+        return {'mtime':os.stat(full_path).st_mtime, 'entries':entries}
+
+    def walk(self, rel_path):
+        '''Lists a folder and everything under it, returns {relative path: record}'''
+        found={}
+        stack=[rel_path]
+        while stack:
+            current=stack.pop()
+            try:
+                record=self.scan_dir(current)
+            except (FileNotFoundError, PermissionError, NotADirectoryError):
+                continue
+            found[current]=record
+            for name, (is_dir, size, mtime) in record['entries'].items():
+                if is_dir:
+                    stack.append(os.path.normpath(os.path.join(current, name)))
+        return found
+
+    def refresh(self):
+        if not self.dirs:
+            root_record=self.scan_dir('.')
+            self.dirs['.']=root_record
+            branches=[name for name, entry in root_record['entries'].items() if entry[0]]
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                for found in pool.map(self.walk, branches):
+                    self.dirs.update(found)
+        else:
+            known=list(self.dirs.keys())
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                mtimes=list(pool.map(self.dir_mtime, known))
+            changed=[]
+            for rel_path, mtime in zip(known, mtimes):
+                if rel_path not in self.dirs:
+                    #already dropped with a removed parent
+                    continue
+                if mtime is None:
+                    self.drop(rel_path)
+                elif mtime!=self.dirs[rel_path]['mtime']:
+                    changed.append(rel_path)
+            for rel_path in changed:
+                old_dirs=set(n for n, e in self.dirs[rel_path]['entries'].items() if e[0])
+                record=self.scan_dir(rel_path)
+                self.dirs[rel_path]=record
+                new_dirs=set(n for n, e in record['entries'].items() if e[0])
+                for name in old_dirs-new_dirs:
+                    self.drop(os.path.normpath(os.path.join(rel_path, name)))
+                for name in new_dirs-old_dirs:
+                    self.dirs.update(self.walk(os.path.normpath(os.path.join(rel_path, name))))
+        if self.manifest_path is not None:
+            self.save()
+
+    def dir_mtime(self, rel_path):
+        try:
+            return os.stat(os.path.join(self.root, rel_path)).st_mtime
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+    def drop(self, rel_path):
+        '''Forgets a folder and everything under it'''
+        prefix=rel_path+os.sep
+        for key in [k for k in self.dirs if k==rel_path or k.startswith(prefix)]:
+            del self.dirs[key]
+
+    def save(self):
+        with open(self.manifest_path, 'w') as f:
+            json.dump({'root':self.root, 'dirs':self.dirs}, f)
+
+    def names(self, path=None):
+        '''Everything in a folder, like os.listdir. path defaults to the root'''
+        return list(self.record(path)['entries'].keys())
+
+    def folders(self, path=None):
+        '''Sub folders of a folder, like folder_list'''
+        return [name for name, entry in self.record(path)['entries'].items() if entry[0]]
+
+    def files(self, path=None):
+        '''{name: (size, mtime)} for the files in a folder'''
+        return {name:(entry[1], entry[2]) for name, entry in self.record(path)['entries'].items() if not entry[0]}
+
+
+class Lazy_frames(MutableMapping):
+    '''
+    A dictionary of dataframes that reads each one the first time its key is used. Used as Data_construct.dfs with lazy=True.
+    If memory_limit (bytes) is set, the least recently used frames are dropped once the frames held go over it, and read
+    again from disk if they are asked for later. Frames put in by hand are kept, since there is no file to reload them from.
+    '''
+    def __init__(self, keys:list, loader:object, memory_limit:int=None):
+        self.keys_known=list(keys)
+        self.loader=loader
+        self.memory_limit=memory_limit
+        self.frames=OrderedDict()
+        self.sizes={}
+        self.pinned=set()
+
+    def __getitem__(self, key):
+        if key in self.frames:
+            self.frames.move_to_end(key)
+            return self.frames[key]
+        if key not in self.keys_known:
+            raise KeyError(key)
+        df=self.loader(key)
+        self.add(key, df)
+        return df
+
+    def __setitem__(self, key, df):
+        if key not in self.keys_known:
+            self.keys_known.append(key)
+        self.pinned.add(key)
+        self.add(key, df)
+
+    def __delitem__(self, key):
+        if key not in self.keys_known:
+            raise KeyError(key)
+        self.keys_known.remove(key)
+        self.pinned.discard(key)
+        self.frames.pop(key, None)
+        self.sizes.pop(key, None)
+
+    def __contains__(self, key):
+        #checking a key shouldn't load the file
+        return key in self.keys_known
+
+    def __iter__(self):
+        return iter(list(self.keys_known))
+
+    def __len__(self):
+        return len(self.keys_known)
+
+    def __repr__(self):
+        return f'Lazy_frames(keys={self.keys_known}, loaded={list(self.frames.keys())})'
+
+    def add(self, key, df):
+        self.frames[key]=df
+        self.frames.move_to_end(key)
+        self.sizes[key]=int(df.memory_usage(deep=True).sum())
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        if self.memory_limit is None:
+            return
+        for key in list(self.frames.keys()):
+            if self.memory_used()<=self.memory_limit:
+                break
+            if key==keep or key in self.pinned:
+                continue
+            del self.frames[key]
+            del self.sizes[key]
+            logger.info(f'{key} dropped from memory, it will be reloaded if used again')
+
+    def memory_used(self)->int:
+        return sum(self.sizes.values())
+
+    def loaded(self)->list:
+        '''Keys currently held in memory, least recently used first'''
+        return list(self.frames.keys())
+
+
 class Data_construct:
     '''
     Data constructs are for loading and organizing dataframes into a notebook
@@ -678,17 +1777,69 @@ class Data_construct:
     The data files will be indexed in a dictionary by whatever shows up after the last underscore in their name
     Data files will be loaded into dataframes indexed in a dictionary with the same keys as the paths
     csv and parquet files are supported
+    workers: number of files to read at the same time. Parquet and csv parsing mostly release the GIL, so threads work well
+    pool: 'thread' or 'process' for the parallel loader
+    memory_limit: bytes. Caps the estimated memory of the files being read at once (file size times memory_factor), 
+    one file is always allowed through even if it's bigger. With lazy=True it is the budget for frames held in dfs instead
+    lazy: if True, run() only finds the paths and dfs becomes a Lazy_frames mapping that reads each file the first time 
+    its key is used, dropping the least recently used frames when memory_limit is passed
+    cache_dir: folder for the csv cache. The first time a csv is read it is also saved there as an arrow (feather) file 
+    keyed by the csv's path, and later loads read that instead of parsing the csv again. None turns the cache off. 
+    Defaults to ~/.cache/data_construct
+    cache_check: 'mtime' re-parses a csv when its size or modified time has changed, 'path' trusts the cache for as long 
+    as the file exists. clear_cache() empties the cache
+    optimize: if True each frame goes through Sort_tools.optimize_dtypes after loading (categories, downcast numbers, 
+    dates) and the memory before and after is printed
+    dtype_overrides: {key: {column: dtype}} for columns where the automatic choice isn't wanted
+    columns: {key: [column, ...]} to only load some columns of a file
+    filters: {key: [(column, op, value), ...]} to only load matching rows. ops are ==, !=, <, <=, >, >=, in, not in. A list 
+    of tuples is ANDed, a list of lists of tuples is ORed (the pyarrow filters format). Parquet files pass both down to 
+    pyarrow, which skips row groups using their statistics. csv files are read with usecols in chunks of csv_chunk_rows 
+    and filtered as they go, so the dropped rows and columns are never a whole dataframe
+    Time taken per file is printed and kept in load_times
+    iter_chunks(key) streams a file as dataframe chunks or arrow record batches without loading it, and 
+    map_chunks(key, func) runs a function on each chunk and combines the results
 
     '''
-    def __init__(self, root_path):
+    #rough in memory size over on disk size, used for memory_limit
+    memory_factor={'csv':2, 'parquet':5}
+    default_cache_dir=os.path.join(os.path.expanduser('~'), '.cache', 'data_construct')
+    csv_chunk_rows=1000000
+    #names cache_names gives out, plus the temp files written on the way
+    cache_file_pattern=re.compile(r'([0-9a-f]{16})(-[0-9a-f]{16})?\.feather(\.\d+\.tmp)?')
+
+    def __init__(self, root_path, manifest=None, workers=1, pool='thread', memory_limit=None, lazy=False, 
+                 cache_dir=default_cache_dir, cache_check='mtime', optimize=False, dtype_overrides=None,
+                 columns=None, filters=None):
         self.root=root_path
-        self.data_list=os.listdir(self.root)
+        #a Folder_manifest saves listing the folder again when one has already been built
+        if manifest is not None:
+            self.data_list=manifest.names(self.root)
+        else:
+            self.data_list=os.listdir(self.root)
         self.data_paths={}
         self.dfs={}
+        self.workers=workers
+        self.pool=pool
+        self.memory_limit=memory_limit
+        self.load_times={}
+        self.lazy=lazy
+        if cache_check not in ('mtime', 'path'):
+            raise ValueError(f"cache_check must be 'mtime' or 'path', got {cache_check}")
+        self.cache_dir=cache_dir
+        self.cache_check=cache_check
+        self.optimize=optimize
+        self.dtype_overrides=dtype_overrides if dtype_overrides is not None else {}
+        self.columns=columns if columns is not None else {}
+        self.filters=filters if filters is not None else {}
         
     def run(self):
         self.process_paths()
-        self.load_dataframes()
+        if self.lazy:
+            keys=[key for key in self.data_paths.keys() if self.file_type(self.data_paths[key]) is not None]
+            self.dfs=Lazy_frames(keys, self.load_key, self.memory_limit)
+        else:
+            self.load_dataframes()
         print('data_paths_found:')
         print(self.data_paths)
         
@@ -702,19 +1853,329 @@ class Data_construct:
                 d_path=os.path.join(self.root, datum)
                 print(f'Adding {dict_key}:{d_path} to analysis')
                 self.data_paths.update({dict_key:d_path})
+
+    @staticmethod
+    def file_type(path:str)->str:
+        '''parquet for .gzip files, csv for .csv files, None for anything else'''
+        test_string=path.split('.')[-1]
+        if test_string=='gzip':
+            return 'parquet'
+        elif test_string=='csv':
+            return 'csv'
+        return None
+
+    @staticmethod
+    def read_file(path:str, cache_dir:str=None, cache_check:str='mtime', optimize:bool=False, dtype_overrides:dict=None,
+                  columns:list=None, filters:list=None)->tuple:
+        '''
+        Reads one data file. csv files go through the cache if cache_dir is set. columns and filters are pushed down into 
+        the read (see the class doc). Returns the dataframe and a dict with the seconds it took, plus memory before and 
+        after if optimize is on
+        '''
+        start=time.perf_counter()
+        if Data_construct.file_type(path)=='parquet':
+            if columns is None and not filters:
+                df=pd.read_parquet(path)
+            else:
+                df=pq.read_table(path, columns=columns, filters=filters if filters else None).to_pandas()
+        elif columns is not None or filters:
+            df=Data_construct.read_csv_pushdown(path, columns, filters, cache_dir, cache_check)
+        elif cache_dir is None:
+            df=pd.read_csv(path)
+        else:
+            df=Data_construct.read_csv_cached(path, cache_dir, cache_check)
+        info={}
+        if optimize or dtype_overrides:
+            info['memory_before']=int(df.memory_usage(deep=True).sum())
+            df=Sort_tools.optimize_dtypes(df, overrides=dtype_overrides, downcast=optimize, categorize=optimize, parse_dates=optimize)
+            info['memory_after']=int(df.memory_usage(deep=True).sum())
+        info['seconds']=time.perf_counter()-start
+        return (df, info)
+
+    def read_options(self, key:str)->dict:
+        '''Keyword arguments for read_file for one key'''
+        return {'cache_dir':self.cache_dir, 'cache_check':self.cache_check, 'optimize':self.optimize, 
+                'dtype_overrides':self.dtype_overrides.get(key), 'columns':self.columns.get(key), 
+                'filters':self.filters.get(key)}
+
+    @staticmethod
+    def filter_columns(filters:list)->list:
+        '''Columns used in a filter list'''
+        if not filters:
+            return []
+        groups=filters if isinstance(filters[0], list) else [filters]
+        return list(dict.fromkeys(column for group in groups for column, op, value in group))
+
+    @staticmethod
+    def filter_mask(df:object, filters:list)->object:
+        '''Boolean mask of the rows of df that pass a pyarrow style filter list'''
+        groups=filters if isinstance(filters[0], list) else [filters]
+        mask=np.zeros(len(df), dtype=bool)
+        for group in groups:
+            group_mask=np.ones(len(df), dtype=bool)
+            for column, op, value in group:
+                col=df[column]
+                #csv dates come in as strings, compare them as dates when the filter value is a date
+                test_value=value[0] if op in ('in', 'not in') and len(value)>0 else value
+                if isinstance(test_value, (dt.date, np.datetime64)):
+                    if not pd.api.types.is_datetime64_any_dtype(col.dtype):
+                        col=pd.to_datetime(col)
+                    #pandas won't compare datetime64 with a plain date, so the value goes to Timestamps too
+                    value=pd.to_datetime(list(value)) if op in ('in', 'not in') else pd.Timestamp(value)
+                if op in ('=', '=='):
+                    hit=col==value
+                elif op=='!=':
+                    #nulls never pass, as in pyarrow
+                    hit=(col!=value)&col.notna()
+                elif op=='<':
+                    hit=col<value
+                elif op=='<=':
+                    hit=col<=value
+                elif op=='>':
+                    hit=col>value
+                elif op=='>=':
+                    hit=col>=value
+                elif op=='in':
+                    hit=col.isin(value)
+                elif op=='not in':
+                    #nulls pass unless the list has a null, pyarrow's is_in matches nulls the same way
+                    hit=~col.isin(value)
+                else:
+                    raise ValueError(f'unknown filter op {op}')
+                group_mask&=hit.fillna(False).to_numpy(dtype=bool)
+            mask|=group_mask
+        return mask
+
+    @staticmethod
+    def read_csv_pushdown(path:str, columns:list, filters:list, cache_dir:str=None, cache_check:str='mtime')->object:
+        '''
+        Reads only the needed columns of a csv and keeps only the rows that pass filters, a chunk at a time. If the csv
+        cache already has the file, the columns are read from the cached copy instead of parsing the csv
+        '''
+        kept=list(Data_construct.csv_chunks(path, columns, filters, Data_construct.csv_chunk_rows, cache_dir, cache_check))
+        if len(kept)==0:
+            return pd.read_csv(path, usecols=columns, nrows=0)
+        return pd.concat(kept, ignore_index=True)
+
+    @staticmethod
+    def csv_chunks(path:str, columns:list, filters:list, chunk_rows:int, cache_dir:str=None, cache_check:str='mtime'):
+        '''
+        Yields filtered, projected dataframe chunks of chunk_rows rows of a csv (filters drop rows from each chunk). A cached 
+        copy is memory mapped and its record batches regrouped to chunk_rows, otherwise the csv is parsed in chunks
+        '''
+        needed=None
+        if columns is not None:
+            needed=list(dict.fromkeys(list(columns)+Data_construct.filter_columns(filters)))
+        cache_path=None
+        if cache_dir is not None:
+            cache_path=os.path.join(cache_dir, Data_construct.cache_names(path, cache_check)[1])
+        if cache_path is not None and os.path.exists(cache_path):
+            reader=pa.ipc.open_file(pa.memory_map(cache_path))
+            batches=(reader.get_batch(i) for i in range(reader.num_record_batches))
+            if needed is not None:
+                batches=(batch.select(needed) for batch in batches)
+            chunks=(table.to_pandas() for table in Data_construct.rebatch(batches, chunk_rows))
+        else:
+            chunks=pd.read_csv(path, usecols=needed, chunksize=chunk_rows)
+        for chunk in chunks:
+            if filters:
+                chunk=chunk[Data_construct.filter_mask(chunk, filters)]
+            if columns is not None:
+                chunk=chunk[list(columns)]
+            yield chunk
+
+    @staticmethod
+    def rebatch(batches:object, chunk_rows:int):
+        '''Regroups a stream of record batches of any size into tables of chunk_rows rows, the last one can be shorter'''
+        pending=[]
+        rows=0
+        for batch in batches:
+            if batch.num_rows==0:
+                continue
+            pending.append(batch)
+            rows+=batch.num_rows
+            while rows>=chunk_rows:
+                table=pa.Table.from_batches(pending)
+                yield table.slice(0, chunk_rows)
+                rest=table.slice(chunk_rows)
+                pending=rest.to_batches()
+                rows=rest.num_rows
+        if rows>0:
+            yield pa.Table.from_batches(pending)
+
+    @staticmethod
+    def regroup(chunks:object, chunk_rows:int):
+        '''The rebatch of dataframes: regroups filtered chunks of any size into chunk_rows rows, skipping empty ones'''
+        pending=[]
+        rows=0
+        for chunk in chunks:
+            if len(chunk)==0:
+                continue
+            pending.append(chunk)
+            rows+=len(chunk)
+            while rows>=chunk_rows:
+                frame=pending[0] if len(pending)==1 else pd.concat(pending)
+                yield frame.iloc[:chunk_rows]
+                rest=frame.iloc[chunk_rows:]
+                pending=[rest] if len(rest)>0 else []
+                rows=len(rest)
+        if rows>0:
+            yield pending[0] if len(pending)==1 else pd.concat(pending)
+
+    def iter_chunks(self, key:str, chunk_rows:int=100000, as_arrow:bool=False):
+        '''
+        Yields a file a piece at a time, for files too big to load whole. Uses the columns, filters and dtype_overrides set
+        for the key (optimize is skipped since categories would differ between chunks).
+        chunk_rows: rows per chunk for csv and parquet files, the last chunk can be shorter. With filters the rows that 
+        pass are regrouped so chunks are still full, and nothing is yielded if no rows pass
+        as_arrow: if True yield pyarrow record batches instead of dataframes
+        '''
+        path=self.data_paths[key]
+        columns=self.columns.get(key)
+        filters=self.filters.get(key)
+        overrides=self.dtype_overrides.get(key)
+        if self.file_type(path)=='parquet':
+            expression=pq.filters_to_expression(filters) if filters else None
+            batches=pa.dataset.dataset(path, format='parquet').to_batches(columns=columns, filter=expression, batch_size=chunk_rows)
+            for table in self.rebatch(batches, chunk_rows):
+                if as_arrow and not overrides:
+                    yield table.combine_chunks().to_batches()[0]
+                    continue
+                chunk=table.to_pandas()
+                if overrides:
+                    chunk=Sort_tools.optimize_dtypes(chunk, overrides=overrides, downcast=False, categorize=False, parse_dates=False)
+                yield pa.RecordBatch.from_pandas(chunk, preserve_index=False) if as_arrow else chunk
+        else:
+            chunks=self.csv_chunks(path, columns, filters, chunk_rows, self.cache_dir, self.cache_check)
+            for chunk in self.regroup(chunks, chunk_rows):
+                if overrides:
+                    chunk=Sort_tools.optimize_dtypes(chunk, overrides=overrides, downcast=False, categorize=False, parse_dates=False)
+                yield pa.RecordBatch.from_pandas(chunk, preserve_index=False) if as_arrow else chunk
+
+    def map_chunks(self, key:str, func:object, combine:object=None, chunk_rows:int=100000)->object:
+        '''
+        Runs func on every chunk of a file (eg a Sort_tools function, with functools.partial for its other arguments) and 
+        combines the partial results.
+        combine: function taking the list of partial results. By default dataframes and series are concatenated, 
+        numbers are added up, and anything else comes back as the list
+        '''
+        partials=[func(chunk) for chunk in self.iter_chunks(key, chunk_rows)]
+        if combine is not None:
+            return combine(partials)
+        if len(partials)>0 and all(isinstance(p, (pd.DataFrame, pd.Series)) for p in partials):
+            return pd.concat(partials, ignore_index=True)
+        if len(partials)>0 and all(isinstance(p, (int, float, np.number)) for p in partials):
+            return sum(partials)
+        return partials
+
+    @staticmethod
+    def cache_names(path:str, cache_check:str)->tuple:
+        '''Cache file name stem for a csv path, and the full cache file name for its current size and mtime'''
+        abs_path=os.path.abspath(path)
+        stem=hashlib.sha1(abs_path.encode()).hexdigest()[:16]
+        if cache_check=='path':
+            return (stem, f'{stem}.feather')
+        stat=os.stat(abs_path)
+        version=hashlib.sha1(f'{stat.st_size}-{stat.st_mtime_ns}'.encode()).hexdigest()[:16]
+        return (stem, f'{stem}-{version}.feather')
+
+    @staticmethod
+    def read_csv_cached(path:str, cache_dir:str, cache_check:str='mtime')->object:
+        stem, name=Data_construct.cache_names(path, cache_check)
+        cache_path=os.path.join(cache_dir, name)
+        if os.path.exists(cache_path):
+            return pd.read_feather(cache_path)
+        df=pd.read_csv(path)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            #clear out caches of older versions of this file
+            for old in Data_construct.cache_files(cache_dir, stem):
+                os.remove(os.path.join(cache_dir, old))
+            #write then rename so a half written file is never read
+            temp_path=f'{cache_path}.{os.getpid()}.tmp'
+            df.to_feather(temp_path)
+            os.replace(temp_path, cache_path)
+        except (OSError, ValueError, TypeError, pa.ArrowException) as e:
+            #columns with mixed types can't be stored, the csv just gets parsed every time
+            logger.warning(f'could not cache {path}: {e}')
+        return df
+
+    def clear_cache(self, key:str=None):
+        '''Removes the cached copy of one key's csv, or every cached csv if key is None. Only cache files are removed'''
+        if self.cache_dir is None or not os.path.isdir(self.cache_dir):
+            return
+        stem=None
+        if key is not None:
+            stem=hashlib.sha1(os.path.abspath(self.data_paths[key]).encode()).hexdigest()[:16]
+        for name in self.cache_files(self.cache_dir, stem):
+            os.remove(os.path.join(self.cache_dir, name))
+
+    @staticmethod
+    def cache_files(cache_dir:str, stem:str=None)->list:
+        '''Names in cache_dir written by the csv cache (for one stem if given), other files in the folder are left alone'''
+        found=[]
+        for name in os.listdir(cache_dir):
+            match=Data_construct.cache_file_pattern.fullmatch(name)
+            if match is not None and (stem is None or match.group(1)==stem):
+                found.append(name)
+        return found
+
+    def estimate_memory(self, key:str)->int:
+        path=self.data_paths[key]
+        return int(os.path.getsize(path)*self.memory_factor[self.file_type(path)])
+
+    def record(self, key:str, info:dict):
+        print(f"{key} loaded from {self.file_type(self.data_paths[key])} in {info['seconds']:.2f}s")
+        if 'memory_before' in info:
+            print(f"{key} memory {info['memory_before']/1024/1024:.1f} mb -> {info['memory_after']/1024/1024:.1f} mb")
+        self.load_times.update({key:info['seconds']})
+
+    def store(self, key:str, df:object, info:dict):
+        self.record(key, info)
+        self.dfs.update({key:df})
+
+    def load_key(self, key:str)->object:
+        '''Reads the file for one key and returns the dataframe, this is what Lazy_frames calls'''
+        df, info=self.read_file(self.data_paths[key], **self.read_options(key))
+        self.record(key, info)
+        return df
                 
     def load_dataframes(self):
         print("*** Loading Data Paths ***")
-        for key in self.data_paths.keys():
-            test_string = self.data_paths[key].split('.')[-1]
-            if test_string =='gzip':
-                df = pd.read_parquet(self.data_paths[key])
-                print(f'{key} loaded from parquet')
-                self.dfs.update({key:df})
-            elif test_string=='csv':
-                df=pd.read_csv(self.data_paths[key])
-                print(f'{key} loaded from csv')
-                self.dfs.update({key:df})
+        keys=[key for key in self.data_paths.keys() if self.file_type(self.data_paths[key]) is not None]
+        if self.workers<=1:
+            for key in keys:
+                df, info=self.read_file(self.data_paths[key], **self.read_options(key))
+                self.store(key, df, info)
+            return
+
+        if self.pool=='process':
+            executor=ProcessPoolExecutor(max_workers=self.workers)
+        elif self.pool=='thread':
+            executor=ThreadPoolExecutor(max_workers=self.workers)
+        else:
+            raise ValueError(f"pool must be 'thread' or 'process', got {self.pool}")
+        queue=list(keys)
+        pending={}
+        in_flight=0
+        with executor:
+            while queue or pending:
+                #start files while there are free workers and room under the memory limit
+                while queue and len(pending)<self.workers:
+                    estimate=self.estimate_memory(queue[0])
+                    if self.memory_limit is not None and pending and in_flight+estimate>self.memory_limit:
+                        break
+                    key=queue.pop(0)
+                    pending[executor.submit(Data_construct.read_file, self.data_paths[key], **self.read_options(key))]=(key, estimate)
+                    in_flight+=estimate
+                done, _=wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key, estimate=pending.pop(future)
+                    in_flight-=estimate
+                    df, info=future.result()
+                    self.store(key, df, info)
+        #same key order as a one at a time load
+        self.dfs={key:self.dfs[key] for key in keys}
 
 
 class Archive: